@@ -1,20 +1,57 @@
 #!/usr/bin/env python3
 
+import mmap
 import os
 import re
-import subprocess
 import sys
 
+# since https://github.blog/2022-04-12-git-security-vulnerability-announced/
+# the workspace must be marked safe; scope it to each git invocation instead
+# of writing to the global git config
+GITHUB_WORKSPACE = os.getenv("GITHUB_WORKSPACE", "/github/workspace")
 
-def is_commit_a_merge_commit(msg):
-    """Check if the commit msg indicates this was a merge commit from a PR
+# Read the runner environment once; GITHUB_TOKEN is optional, as PyGithub can
+# query public repositories unauthenticated
+GH_TOKEN = os.getenv("GITHUB_TOKEN")
+GH_REPO = os.getenv("GITHUB_REPOSITORY")
+GH_OUTPUT = os.getenv("GITHUB_OUTPUT")
 
-    Performs a case insensitive check for strings "Merge pull request"
+# CMakeLists.txt files larger than this are memory mapped instead of read
+_MMAP_THRESHOLD = 64 * 1024
+
+_VERSION_RE = re.compile(
+    rb"project\(.*?VERSION.*?(\d+\.\d+\.\d+).*?\)",
+    re.MULTILINE | re.IGNORECASE | re.DOTALL,
+)
+_TRIGGERS_RE = re.compile(
+    r"(?P<merge>merge pull request)"
+    r"|(?P<major>bump\s+version\s+major|bump\s+major\s+version|#major)"
+    r"|(?P<minor>bump\s+version\s+minor|bump\s+minor\s+version|#minor)",
+    re.IGNORECASE,
+)
+
+
+def _require_env(**env):
+    """Exit with an error naming any of the given environment variables unset"""
+    missing = [name for name, value in env.items() if not value]
+    if missing:
+        print(f"Missing required environment variable(s): {', '.join(missing)}")
+        sys.exit(-1)
+
+
+def classify(text):
+    """Scan commit msg or merge request text for merge and version bump triggers
+
+    Performs a single case insensitive pass for the strings
+      - "merge pull request" (merge)
+      - "bump version major", "bump major version" or "#major" (major)
+      - "bump version minor", "bump minor version" or "#minor" (minor)
+    and returns a dict mapping each of merge/major/minor to whether it was found
     """
-    if msg is None:
-        return False
-    else:
-        return "merge pull request" in msg.lower()
+    flags = {"merge": False, "major": False, "minor": False}
+    for m in _TRIGGERS_RE.finditer(text or ""):
+        flags[m.lastgroup] = True
+    return flags
 
 
 def get_merge_request_description(sha):
@@ -22,20 +59,35 @@ def get_merge_request_description(sha):
 
     returns None if a merge request was not found
     """
+    _require_env(GITHUB_REPOSITORY=GH_REPO)
     import github
 
     description = None
-    gh = github.Github(os.getenv("GITHUB_TOKEN"))
-
-    # Get PR desc via the input SHA
-    repo = gh.get_repo(os.getenv("GITHUB_REPOSITORY"))
-    commit = repo.get_commit(sha)
-    # The get_pulls function grabs all merged PRs that includes the commit SHA in question
-    # Although it can be more than one, let's keep our code simple by conditioning the
-    # success of this code to the assumption that there's only one returned and it is already merged
-    pull_reqs = commit.get_pulls()
-    if pull_reqs.totalCount == 1 and pull_reqs[0].is_merged():
-        description = pull_reqs[0].body
+    gh = github.Github(GH_TOKEN)
+
+    # Get PR desc via the input SHA with a single search query, reading just its
+    # first page; only succeed when exactly one merged PR is associated with it
+    query = f"repo:{GH_REPO} is:pr is:merged {sha}"
+    try:
+        hits = gh.search_issues(query).get_page(0)
+        if len(hits) == 1:
+            # the issue body of a PR search hit is the PR description
+            description = hits[0].body
+    except github.RateLimitExceededException:
+        # The search API has a much smaller rate limit; fall through below
+        pass
+
+    # The search index is eventually consistent and may not list a PR that was
+    # just merged, so fall back to listing the PRs of the commit
+    if description is None:
+        repo = gh.get_repo(GH_REPO)
+        commit = repo.get_commit(sha)
+        # The get_pulls function grabs all merged PRs that includes the commit SHA in question
+        # Although it can be more than one, let's keep our code simple by conditioning the
+        # success of this code to the assumption that there's only one returned and it is already merged
+        pull_reqs = commit.get_pulls()
+        if pull_reqs.totalCount == 1 and pull_reqs[0].is_merged():
+            description = pull_reqs[0].body
 
     if description is None:
         print("Unable to retrieve an associated pull request description")
@@ -43,139 +95,77 @@ def get_merge_request_description(sha):
     return description
 
 
-def is_bump_major_requested(description):
-    """Check if bump major was description in merge request text"
-
-    performs a case insensitive check for strings "bump version major"
-    or "bump major version"
-    """
-    if description is None:
-        return False
-    else:
-        key_phrases = ["bump version major", "bump major version", "#major"]
-        return any([phrase in description.lower() for phrase in key_phrases])
-
-
-def is_bump_minor_requested(description):
-    """Check if bump major was description in merge request text"
-
-    performs a case insensitive check for strings "bump version minor"
-    or "bump minor version"
-    """
-    if description is None:
-        return False
-    else:
-        key_phrases = ["bump version minor", "bump minor version", "#minor"]
-        return any([phrase in description.lower() for phrase in key_phrases])
-
-
 def parse_cmakelists_for_version(fpath_cmakelists):
     """Parses input CMakeLists.txt file for version string with regex
 
     Returns
-      - a re.Match object for further dissection
-      - the lines of the read CMakeLists for search and replace
+      - a re.Match object for further dissection, with byte offsets
+      - the lines of the read CMakeLists for search and replace, as bytes or
+        as a read-only mmap for large files; patch_cmakelists_txt closes the
+        mmap once it is done with it
     """
     try:
-        with open(fpath_cmakelists) as f:
-            lines = f.read()
+        with open(fpath_cmakelists, "rb") as f:
+            if os.fstat(f.fileno()).st_size > _MMAP_THRESHOLD:
+                lines = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                lines = f.read()
     except IOError:
         print(f"No {fpath_cmakelists} found in this repository")
         return None
 
-    r = re.compile(
-        r"project\(.*?VERSION.*?(\d+\.\d+\.\d+).*?\)",
-        re.MULTILINE | re.IGNORECASE | re.DOTALL,
-    )
-    return (r.search(lines), lines)
-
+    return (_VERSION_RE.search(lines), lines)
 
-def get_semantic_tags_from_git():
-    """Uses PyGithub to return a list of git tags"""
-    import github
-
-    gh = github.Github(os.getenv("GITHUB_TOKEN"))
-    repo = gh.get_repo(os.getenv("GITHUB_REPOSITORY"))
-    tags = repo.get_tags()
-
-    return [tag.name for tag in tags]
-
-
-def get_latest_semantic_tag():
-    """Given a list of semantic tags, returns the latest one through sorting"""
-    tags = get_semantic_tags_from_git()
-    if tags is None:
-        return None
-    try:
-        # For each elem, convert to a version, which is a tuple of the
-        # major/minor/patch number. Then, sort in ascending order for
-        # each element of the tuple, with a bias towards major,
-        # then minor, then patch
-        sorted_versions = sorted(
-            [get_version_from_tag(tag) for tag in tags],
-            key=lambda x: (x[0], x[1], x[2]),
-        )
-        return get_tag_from_version(sorted_versions[-1])
-    except IndexError:
-        return None
 
+def get_version_info_from_cmakelists_txt(parsed):
+    """Retrieve semantic version info from parsed CMakeLists.txt as a tuple of integers
 
-def get_version_from_tag(tag):
-    """Retrieve semantic version info from project tag as a list of integers
-
-    Returns semantic version information from a tag in the form of
-    "v0.0.1" as a list of integers; returns None if the string could not be
-    converted to a list of integers
+    Takes the result of parse_cmakelists_for_version; returns None if no
+    CMakeLists.txt file exists or no version information is available
     """
-    if tag is None:
-        return None
-    match = re.findall(r"\d+", tag)
-    if len(match) != 3:
+    if parsed is None or parsed[0] is None:
         return None
-    try:
-        match = [int(i) for i in match]
-    except (ValueError, TypeError):
-        return None
-    return match
-
+    return tuple(int(i) for i in parsed[0].group(1).split(b"."))
 
-def get_tag_from_version(version):
-    """Convert a list of three integers to a tag in string format
 
-    For example, [0, 0, 1] is converted to "v0.0.1"
-    """
-    return "v%d.%d.%d" % tuple(version)
-
-
-def get_next_version(bump_major=False, bump_minor=False):
-    """Get latest tag and increment, patch, version_minor, or version_major
+def get_next_version(current_version, bump_major=False, bump_minor=False):
+    """Increment patch, version_minor, or version_major of the current version
     Returns the new latest version, the previous latest version and the part that got bumped
     """
     # Assume the part that gets bumped is the patch number
     part = "patch"
-    latest_tag = get_latest_semantic_tag()
-    # If no tags exist, create an initial v0.0.1 release
-    if latest_tag is None:
-        return ([0, 0, 1], [0, 0, 0], part)
+    # If no version exists yet, create an initial v0.0.1 release
+    if current_version is None:
+        return ((0, 0, 1), (0, 0, 0), part)
 
-    current_version = get_version_from_tag(latest_tag)
-    latest_version = current_version.copy()
     if bump_major:
-        latest_version = [latest_version[0] + 1, 0, 0]
+        latest_version = (current_version[0] + 1, 0, 0)
         part = "major"
     elif bump_minor:
-        latest_version = [latest_version[0], latest_version[1] + 1, 0]
+        latest_version = (current_version[0], current_version[1] + 1, 0)
         part = "minor"
     else:
-        latest_version[2] += 1
+        latest_version = (
+            current_version[0],
+            current_version[1],
+            current_version[2] + 1,
+        )
 
     return (latest_version, current_version, part)
 
 
-def patch_cmakelists_txt(version):
+def _close_mmap(lines):
+    """Close lines if it is a mmap returned by parse_cmakelists_for_version"""
+    if isinstance(lines, mmap.mmap) and not lines.closed:
+        lines.close()
+
+
+def patch_cmakelists_txt(version, parsed=None):
     """Patch CMakeLists.txt with current version information
 
-    Patches current CMakeLists version information
+    Patches current CMakeLists version information; pass the result of a prior
+    parse_cmakelists_for_version call as parsed to avoid reading the file again;
+    a mmap in parsed is closed before returning and must not be used afterwards
 
     returns True if CMakeLists.txt was patched;
             current_version and version info did not match
@@ -184,61 +174,101 @@ def patch_cmakelists_txt(version):
     returns None if no CMakeLists.txt file exists or no version information
             available
     """
-    m, lines = parse_cmakelists_for_version("CMakeLists.txt")
-    current_version = None
-    if len(m.groups()) == 0:
-        print("Could not find version information in CMakeLists.txt")
+    if parsed is None:
+        parsed = parse_cmakelists_for_version("CMakeLists.txt")
+    if parsed is None:
         return None
+    m, lines = parsed
     try:
-        current_version = [int(i) for i in m.group(1).split(".")]
-    except Exception:
-        return None
-
-    if current_version != version:
-        s = m.span(1)
-        # fmt: off
-        lines = lines[:s[0]] + "%d.%d.%d" % tuple(version) + lines[s[1]:]
-        # fmt: on
-        with open("CMakeLists.txt", "w") as f:
-            f.write(lines)
-        subprocess.call(["git", "add", "CMakeLists.txt"])
-        return True
-    else:
-        return False
+        current_version = get_version_info_from_cmakelists_txt(parsed)
+        if current_version is None:
+            print("Could not find version information in CMakeLists.txt")
+            return None
+
+        if current_version != version:
+            s = m.span(1)
+            new_slice = b"%d.%d.%d" % tuple(version)
+            if len(new_slice) == s[1] - s[0]:
+                # Same number of digits, so overwrite just the version in place
+                fd = os.open("CMakeLists.txt", os.O_WRONLY)
+                try:
+                    os.pwrite(fd, new_slice, s[0])
+                finally:
+                    os.close(fd)
+            else:
+                # fmt: off
+                patched = lines[:s[0]] + new_slice + lines[s[1]:]
+                # fmt: on
+                # lines may be a mmap of this very file, so unmap before truncating
+                _close_mmap(lines)
+                with open("CMakeLists.txt", "wb") as f:
+                    f.write(patched)
+            status = os.spawnvp(
+                os.P_WAIT,
+                "git",
+                [
+                    "git",
+                    "-c",
+                    f"safe.directory={GITHUB_WORKSPACE}",
+                    "add",
+                    "CMakeLists.txt",
+                ],
+            )
+            if status != 0:
+                print(f"Unable to stage CMakeLists.txt, git exited with {status}")
+                sys.exit(-1)
+            return True
+        else:
+            return False
+    finally:
+        _close_mmap(lines)
 
 
 ##########
 ## MAIN ##
 ##########
 
-# since https://github.blog/2022-04-12-git-security-vulnerability-announced/ runner uses?
-cmd = "git config --global --add safe.directory /github/workspace"
-subprocess.call(cmd.split())
-
-commit_msg = None
-commit_sha = None
-if len(sys.argv) > 2:
-    commit_msg = sys.argv[1]
-    commit_sha = sys.argv[2]
-    print(f"The commit_msg is:\n\t'{commit_msg}'")
-    print(f"The commit_sha is:\n\t'{commit_sha}'")
 
-if is_commit_a_merge_commit(commit_msg):
-    commit_msg = get_merge_request_description(commit_sha)
-
-new_version, current_version, bumped = get_next_version(
-    is_bump_major_requested(commit_msg), is_bump_minor_requested(commit_msg)
-)
-patch_cmakelists_txt(new_version)
-
-# Save and report on outputs of this action
-outputs = {
-    "old_tag": f"v{'.'.join(map(str, current_version))}",
-    "new_tag": f"v{'.'.join(map(str, new_version))}",
-    "bumped": f"{bumped}",
-}
-fp_github_output = os.getenv("GITHUB_OUTPUT")
-with open(fp_github_output, "a") as fp:
-    for key in outputs.keys():
-        fp.write(f"{key}={outputs[key]}\n")
-        print(f"{key}={outputs[key]}")
+def main():
+    _require_env(GITHUB_OUTPUT=GH_OUTPUT)
+
+    commit_msg = None
+    commit_sha = None
+    if len(sys.argv) > 2:
+        commit_msg = sys.argv[1]
+        commit_sha = sys.argv[2]
+        print(f"The commit_msg is:\n\t'{commit_msg}'")
+        print(f"The commit_sha is:\n\t'{commit_sha}'")
+
+    triggers = classify(commit_msg)
+    # Merge the bump requests of the commit msg with those of the merge request
+    # text; skip looking up the latter when a major bump, which takes
+    # precedence, is already requested
+    if triggers["merge"] and not triggers["major"]:
+        pr = classify(get_merge_request_description(commit_sha))
+        triggers["major"] |= pr["major"]
+        triggers["minor"] |= pr["minor"]
+
+    parsed = parse_cmakelists_for_version("CMakeLists.txt")
+    new_version, current_version, bumped = get_next_version(
+        get_version_info_from_cmakelists_txt(parsed),
+        triggers["major"],
+        triggers["minor"],
+    )
+    if parsed is not None:
+        patch_cmakelists_txt(new_version, parsed=parsed)
+
+    # Save and report on outputs of this action
+    outputs = {
+        "old_tag": "v%d.%d.%d" % tuple(current_version),
+        "new_tag": "v%d.%d.%d" % tuple(new_version),
+        "bumped": f"{bumped}",
+    }
+    payload = "".join(f"{key}={value}\n" for key, value in outputs.items())
+    with open(GH_OUTPUT, "a") as fp:
+        fp.write(payload)
+    print(payload, end="")
+
+
+if __name__ == "__main__":
+    main()